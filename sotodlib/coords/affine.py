@@ -29,23 +29,30 @@ def get_affine(src, dst, centered=False):
 
         shift: Shift to apply after transformation.
     """
-    msk = np.isfinite(src).all(axis=0) * np.isfinite(dst).all(axis=0)
+    msk = np.isfinite(src).all(axis=0)
+    msk &= np.isfinite(dst).all(axis=0)
     if np.sum(msk) < len(src):
         raise ValueError("Not enough finite points to compute transformation")
 
-    src_c, dst_c = src, dst
+    # Masked copies are reused for the system and the shift below
+    src_m = src[:, msk]
+    dst_m = np.asarray(dst[:, msk], dtype=float)
+
+    # Fill the (npoints, 2*ndim) system in place rather than stacking copies
+    ndim = len(src)
+    M = np.empty((src_m.shape[-1], 2 * ndim))
+    M[:, :ndim] = src_m.T
+    M[:, ndim:] = dst_m.T
     if not centered:
-        src_c = src - np.median(src[:, msk], axis=1)[:, None]
-        dst_c = dst - np.median(dst[:, msk], axis=1)[:, None]
-    M = np.vstack((src_c[:, msk], dst_c[:, msk])).T
-    *_, vh = la.svd(M)
-    vh_splits = [
-        quad for half in np.split(vh.T, 2, axis=0) for quad in np.split(half, 2, axis=1)
-    ]
-    affine = np.dot(vh_splits[2], la.pinv(vh_splits[0]))
-
-    transformed = affine @ src[:, msk]
-    shift = np.median(dst[:, msk] - transformed, axis=1)
+        M -= np.median(M, axis=0)
+    *_, vh = la.svd(M, full_matrices=False, overwrite_a=True, check_finite=False)
+    # Leading ndim right singular vectors, split into src and dst blocks
+    v = vh[:ndim].T
+    affine = la.lstsq(v[:ndim].T, v[ndim:].T, cond=None, check_finite=False)[0].T
+
+    # dst_m is our own copy, so the residuals and median can reuse it
+    dst_m -= affine @ src_m
+    shift = np.median(dst_m, axis=1, overwrite_input=True)
 
     return affine, shift
 
@@ -71,11 +78,9 @@ def get_affine_weighted(src, dst, weights):
 
         shift: Shift to apply after transformation.
     """
-    msk = (
-        np.isfinite(src).all(axis=0)
-        * np.isfinite(dst).all(axis=0)
-        * np.isfinite(weights)
-    )
+    msk = np.isfinite(src).all(axis=0)
+    msk &= np.isfinite(dst).all(axis=0)
+    msk &= np.isfinite(weights)
     if np.sum(msk) < 7:
         raise ValueError("Not enough finite points to compute transformation")
     init_shift = weighted_shift(src, dst, weights)
@@ -227,7 +232,8 @@ def estimate_var(src, dst):
 
         var: (ndim,) array of variances.
     """
-    msk = np.isfinite(src).all(axis=0) * np.isfinite(dst).all(axis=0)
+    msk = np.isfinite(src).all(axis=0)
+    msk &= np.isfinite(dst).all(axis=0)
     norm = np.sum(msk) ** 2
     ndim, _ = src.shape
     var = np.zeros(ndim)
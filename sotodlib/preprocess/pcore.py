@@ -1,6 +1,8 @@
 """Base Class and PIPELINE register for the preprocessing pipeline scripts."""
 import os
 import logging
+import functools
+import concurrent.futures
 import numpy as np
 from .. import core
 from so3g.proj import Ranges, RangesMatrix
@@ -176,27 +178,47 @@ class _Preprocess(object):
 def _zeros_cls( item ):
     """return a callable zeros class that exactly matches type item for use 
     with wrap_new"""
-    if isinstance( item, np.ndarray):
-        return lambda shape: np.zeros( shape, dtype = item.dtype)
-    elif isinstance( item, RangesMatrix):
+    return _zeros_cls_cached( type(item), getattr(item, 'dtype', None))
+
+@functools.lru_cache(maxsize=None)
+def _zeros_cls_cached( cls, dtype ):
+    """zeros constructor for objects of type cls with dtype, cached since
+    most fields share a handful of (cls, dtype) pairs"""
+    if issubclass( cls, np.ndarray):
+        return lambda shape: np.zeros( shape, dtype = dtype)
+    elif issubclass( cls, RangesMatrix):
         return RangesMatrix.zeros
-    elif isinstance( item, Ranges ):
+    elif issubclass( cls, Ranges ):
         def temp(shape):
             assert len(shape) == 1
             return Ranges( shape[0] )
         return temp
-    elif isinstance( item, csr_array):
-        return lambda shape: csr_array(tuple(shape), dtype=item.dtype)
+    elif issubclass( cls, csr_array):
+        return lambda shape: csr_array(tuple(shape), dtype=dtype)
     else:
-        raise ValueError(f"Cannot find zero type for {type(item)}")
+        raise ValueError(f"Cannot find zero type for {cls}")
 
 def _reform_csr_array(arr, oidx, nidx, shape):
     # Support function for _expand, to efficiently embed a csr_array
     # in an expanded frame.  Assumptions are that arr is 2d, with
     # shape (dets, samps).  So oidx and nidx each contain (array of
     # idx, slice).
-    row_map = {n: o for n, o in zip(nidx[0], oidx[0])}
+    row_map = np.full(arr.shape[0], -1, dtype=int)
+    row_map[nidx[0]] = oidx[0]
+    if np.any(row_map < 0):
+        raise ValueError("Every row of arr must be mapped by nidx")
     col_shift = oidx[1].start - nidx[1].start
+    row_counts = np.diff(arr.indptr)
+
+    if np.all(np.diff(row_map) > 0):
+        # Rows keep their order, so the data and (shifted) indices
+        # can be reused as-is; only the row pointers need to be
+        # spread out over the expanded rows.
+        indptr = np.zeros(shape[0] + 1, dtype=arr.indptr.dtype)
+        indptr[row_map + 1] = row_counts
+        np.cumsum(indptr, out=indptr)
+        return csr_array((arr.data.copy(), arr.indices + col_shift, indptr),
+                         shape=shape, dtype=arr.dtype)
 
     # For coo array you have:
     #    r, c, v = arr.row, arr.col, arr.data
@@ -206,9 +228,8 @@ def _reform_csr_array(arr, oidx, nidx, shape):
     #    v = arr.data
     # So the expression for r1, here, is equivalent to
     #    r = np.repeat(np.arange(arr.shape[0]), np.diff(arr.indptr))
-    #    r1 = [row_map[_r] for _r in r]
-    r1 = np.repeat([row_map[_r] for _r in range(arr.shape[0])],
-                   np.diff(arr.indptr))
+    #    r1 = row_map[r]
+    r1 = np.repeat(row_map, row_counts)
     c1 = arr.indices + col_shift
     v = arr.data
     return csr_array((v, (r1, c1)), shape=shape, dtype=arr.dtype)
@@ -218,6 +239,8 @@ def _ranges_matrix_match( o, n, oidx, nidx):
     assert len(oidx)==len(nidx)
     if len(oidx) > 2:
         raise NotImplemented
+    # per row so each can take the interval endpoint path in _ranges_match
+    # without building any (dets, samps) sized masks
     for i, x in zip( oidx[0], nidx[0]):
         o.ranges[i] = _ranges_match( 
             o.ranges[i], n.ranges[x],
@@ -229,55 +252,111 @@ def _ranges_match( o, n, oidx, nidx):
     """align Ranges n to Ranges o"""
     assert len(oidx)==len(nidx)
     assert len(oidx)==1
+    if isinstance(oidx[0], slice) and isinstance(nidx[0], slice):
+        o_start, o_stop, o_step = oidx[0].indices(o.count)
+        n_start, n_stop, n_step = nidx[0].indices(n.count)
+        if (o_step == 1 and n_step == 1 and 
+                o_stop - o_start == n_stop - n_start):
+            # contiguous samples, so work on the interval endpoints
+            r = np.clip(n.ranges(), n_start, n_stop)
+            r = r[r[:,1] > r[:,0]] + (o_start - n_start)
+            window = Ranges.from_array(
+                np.array([[o_start, o_stop]], dtype=np.int32), o.count
+            )
+            return (o * ~window) + Ranges.from_array(
+                r.astype(np.int32), o.count
+            )
     omsk = o.mask()
     nmsk = n.mask()
     omsk[oidx[0]] = nmsk[nidx[0]]
     return Ranges.from_mask(omsk)
 
-def _expand(new, full, wrap_valid=True):
+def _intersect_axes(f_ax, n_ax, cache=None):
+    """return the (full, new) index selectors of f_ax.intersection(n_ax),
+    memoizing LabelAxis intersections (which require a sort) in cache"""
+    if cache is None or not isinstance(n_ax, core.LabelAxis):
+        _, fs, ns = f_ax.intersection(n_ax, return_slices=True)
+        return fs, ns
+    entries = cache.setdefault(n_ax.name, [])
+    for c_f, c_n, fs, ns in entries:
+        if c_f is f_ax and (c_n is n_ax or np.array_equal(c_n.vals, n_ax.vals)):
+            return fs, ns
+    _, fs, ns = f_ax.intersection(n_ax, return_slices=True)
+    entries.append((f_ax, n_ax, fs, ns))
+    return fs, ns
+
+def _same_axes(new, full):
+    """True if the dets and samps axes of new (where present) match full"""
+    if 'dets' in new._axes:
+        if (new.dets.count != full.dets.count or 
+                not np.array_equal(new.dets.vals, full.dets.vals)):
+            return False
+    if 'samps' in new._axes:
+        if (new.samps.count != full.samps.count or
+                getattr(new.samps, 'offset', 0) != getattr(full.samps, 'offset', 0)):
+            return False
+    return True
+
+def _expand(new, full, wrap_valid=True, cache=None):
     """new will become a top level axismanager in full once it is matched to
     size"""
+    if cache is None:
+        cache = {}
+    if _same_axes(new, full):
+        # nothing to re-index, so reference the data directly
+        out = new.copy(axes_only=True)
+        for a in ['dets', 'samps']:
+            if a not in out._axes:
+                out._axes[a] = full._axes[a]
+        for k, v in new._fields.items():
+            if isinstance(v, core.AxisManager):
+                out.wrap( k, _expand( v, full, cache=cache) )
+            else:
+                out._fields[k] = v
+                out._assignments[k] = list(new._assignments[k])
+        if wrap_valid:
+            valid = RangesMatrix.ones((full.dets.count, full.samps.count))
+            out.wrap('valid',valid,[(0,'dets'),(1,'samps')])
+        return out
     if 'dets' in new._axes:
-        _, fs_dets, ns_dets = full.dets.intersection(
-            new.dets, 
-            return_slices=True
-        )
+        fs_dets, ns_dets = _intersect_axes(full.dets, new.dets, cache)
     else:
         fs_dets = range(full.dets.count)
     if 'samps' in new._axes:
-        _, fs_samps, ns_samps = full.samps.intersection(
-            new.samps, 
-            return_slices=True
-        )
+        fs_samps, ns_samps = _intersect_axes(full.samps, new.samps, cache)
     else:
         fs_samps = slice(None)
 
     out = core.AxisManager()
+    keep_axes = set(new._axes) | {'dets', 'samps'}
     for k, v in full._axes.items():
-        if k in list(new._axes.keys())+['dets','samps']:
+        if k in keep_axes:
             out._axes[k] = v 
 
     for a in new._axes:
         if a not in out:
             out.add_axis( new[a] )
+    assignment_idx = {}
     for k, v in new._fields.items():
         if isinstance(v, core.AxisManager):
-            out.wrap( k, _expand( v, full) )
+            out.wrap( k, _expand( v, full, cache=cache) )
         else:
             out.wrap_new( k, new._assignments[k], cls=_zeros_cls(v))
-            oidx=[]; nidx=[]
-            for a in new._assignments[k]:
-                if a == 'dets':
-                    oidx.append(fs_dets)
-                    nidx.append(ns_dets)
-                elif a == 'samps':
-                    oidx.append(fs_samps)
-                    nidx.append(ns_samps)
-                else:
-                    oidx.append(slice(None))
-                    nidx.append(slice(None))
-            oidx = tuple(oidx)
-            nidx = tuple(nidx)
+            assignment = tuple(new._assignments[k])
+            if assignment not in assignment_idx:
+                oidx=[]; nidx=[]
+                for a in assignment:
+                    if a == 'dets':
+                        oidx.append(fs_dets)
+                        nidx.append(ns_dets)
+                    elif a == 'samps':
+                        oidx.append(fs_samps)
+                        nidx.append(ns_samps)
+                    else:
+                        oidx.append(slice(None))
+                        nidx.append(slice(None))
+                assignment_idx[assignment] = (tuple(oidx), tuple(nidx))
+            oidx, nidx = assignment_idx[assignment]
             if isinstance(out[k], RangesMatrix):
                 assert new._assignments[k][-1] == 'samps'
                 out[k] = _ranges_matrix_match( out[k], v, oidx, nidx)
@@ -295,16 +374,37 @@ def _expand(new, full, wrap_valid=True):
         m[fs_samps] = True
         v = Ranges.from_mask(m)
 
+        is_valid = np.zeros(full.dets.count, dtype=bool)
+        is_valid[fs_dets] = True
         valid = RangesMatrix( 
-            [v if i in fs_dets else x for i in range(full.dets.count)]
+            [v if is_valid[i] else x for i in range(full.dets.count)]
         )
         out.wrap('valid',valid,[(0,'dets'),(1,'samps')])
     return out
 
-def update_full_aman(proc_aman, full, wrap_valid):
+def _shallow_axis_copy(aman):
+    """return a new AxisManager tree with the axes and structure of aman whose
+    data fields reference, rather than copy, the data in aman"""
+    out = aman.copy(axes_only=True)
+    for k, v in aman._fields.items():
+        if isinstance(v, core.AxisManager):
+            out._fields[k] = _shallow_axis_copy(v)
+        else:
+            out._fields[k] = v
+    for k, v in aman._assignments.items():
+        out._assignments[k] = v.copy()
+    return out
+
+def update_full_aman(proc_aman, full, wrap_valid, n_threads=1):
     """Copy new fields from proc_aman[dets,samps] over to 
     full[full-dets,full-samps] after correct re-sizing and indexing.
 
+    Fields whose dets and samps axes already match full are not copied:
+    full references the same arrays, Ranges, etc. as proc_aman (and so
+    possibly as the TOD AxisManager, if a process wrapped them into both).
+    Modifying such data in place changes it in every container. Fields
+    that need re-indexing are copied into newly allocated objects.
+
     Arguments
     ----------
     proc_aman: AxisManager
@@ -313,14 +413,38 @@ def update_full_aman(proc_aman, full, wrap_valid):
     full: AxisManager
         A full shape AxisManager that begins the pipeline as the original shape
         of the TOD AxisManager
+    wrap_valid: bool
+        If True, wrap a ``valid`` RangesMatrix into each expanded field
+    n_threads: int (Optional)
+        Maximum number of threads used to expand new fields concurrently.
+        Defaults to 1, expanding the fields serially.
     """
-    for fld in proc_aman._fields:
-        if fld not in full._fields:
-            assert isinstance(proc_aman[fld], core.AxisManager)
-            full.wrap( 
-                fld,
-                _expand( proc_aman[fld], full, wrap_valid=wrap_valid)
-            )
+    # axis intersections are shared between the expanded fields; full's
+    # axes are replaced each time it wraps a field, so this is per call.
+    # All new fields are expanded before any is wrapped: _expand only
+    # reads full's axes, whose values wrapping does not change, so the
+    # result is the same as wrapping each in turn and the cache stays
+    # valid. Threads may both miss and add an equal entry, which is
+    # harmless.
+    cache = {}
+    new_flds = [fld for fld in proc_aman._fields if fld not in full._fields]
+    for fld in new_flds:
+        assert isinstance(proc_aman[fld], core.AxisManager)
+
+    def _expand_fld(fld):
+        return _expand( proc_aman[fld], full, wrap_valid=wrap_valid,
+                        cache=cache)
+
+    if n_threads > 1 and len(new_flds) > 1:
+        # The fields are independent, but much of _expand is python level
+        # AxisManager bookkeeping, so the speedup depends on how much of
+        # the work is in numpy/so3g array operations
+        with concurrent.futures.ThreadPoolExecutor(n_threads) as e:
+            expanded = list(e.map(_expand_fld, new_flds))
+    else:
+        expanded = [_expand_fld(fld) for fld in new_flds]
+    for fld, out in zip(new_flds, expanded):
+        full.wrap( fld, out)
 
 class Pipeline(list):
     """This class is designed to create and run pipelines out of a series of
@@ -331,7 +455,8 @@ class Pipeline(list):
 
     PIPELINE = {}
 
-    def __init__(self, modules, plot_dir='./', logger=None, wrap_valid=True):
+    def __init__(self, modules, plot_dir='./', logger=None, wrap_valid=True,
+                 n_threads=1):
         """
         Arguments
         ---------
@@ -343,12 +468,18 @@ class Pipeline(list):
             Directory prefix for preprocess plots
         logger: optional
             logging.logger instance used by the pipeline to send updates
+        wrap_valid: bool
+            If True, wrap a ``valid`` RangesMatrix into each expanded field
+        n_threads: int
+            Number of threads used to expand the new fields of a step into
+            the full AxisManager. Defaults to 1 (serial).
         """
         if logger is None:
             logger = logging.getLogger("pipeline")
         self.logger = logger
         self.plot_dir = plot_dir
         self.wrap_valid = wrap_valid
+        self.n_threads = n_threads
         super().__init__( [self._check_item(item) for item in modules])
     
     def _check_item(self, item):
@@ -411,7 +542,10 @@ class Pipeline(list):
         -------
         proc_aman: AxisManager
             A preprocess axismanager that contains all data products calculated
-            throughout the running of the pipeline
+            throughout the running of the pipeline. Data products computed
+            before any detectors were cut, and all products when resuming from
+            a given proc_aman, share their data with proc_aman rather than
+            being copies (see ``update_full_aman``).
         
         """
         if proc_aman is None:
@@ -419,12 +553,14 @@ class Pipeline(list):
             full = core.AxisManager( aman.dets, aman.samps)
             run_calc = True
         else:
-            if aman.dets.count != proc_aman.dets.count or not np.all(aman.dets.vals == proc_aman.dets.vals):
+            if (aman.dets.vals is not proc_aman.dets.vals) and (
+                    aman.dets.count != proc_aman.dets.count or 
+                    not np.array_equal(aman.dets.vals, proc_aman.dets.vals)):
                 self.logger.warning("proc_aman has different detectors than aman. Cutting aman to match")
                 det_list = [det for det in proc_aman.dets.vals if det in aman.dets.vals]
                 aman.restrict('dets', det_list)
                 proc_aman.restrict('dets', det_list)
-            full = proc_aman.copy()
+            full = _shallow_axis_copy(proc_aman)
             run_calc = False
         
         success = 'end'
@@ -434,10 +570,13 @@ class Pipeline(list):
             if run_calc:
                 process.calc_and_save(aman, proc_aman)
                 process.plot(aman, proc_aman, filename=os.path.join(self.plot_dir, '{ctime}/{obsid}', f'{step+1}_{{name}}.png'))
-                update_full_aman( proc_aman, full, self.wrap_valid)
+                update_full_aman( proc_aman, full, self.wrap_valid,
+                                  n_threads=self.n_threads)
             if select:
                 process.select(aman, proc_aman)
-                proc_aman.restrict('dets', aman.dets.vals)
+                # restrict copies every field, so skip it if no dets were cut
+                if aman.dets.count != proc_aman.dets.count:
+                    proc_aman.restrict('dets', aman.dets.vals)
             self.logger.debug(f"{proc_aman.dets.count} detectors remaining")
             
             if aman.dets.count == 0:
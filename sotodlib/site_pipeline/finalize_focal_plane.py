@@ -1,6 +1,8 @@
 import argparse as ap
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 import os
+import threading
 from dataclasses import InitVar, dataclass, field
 from typing import Dict, List, Optional
 
@@ -14,7 +16,7 @@ from scipy.cluster import vq
 from scipy.optimize import minimize
 from sotodlib.coords import affine as af
 from sotodlib.coords import optics as op
-from sotodlib.core import AxisManager, Context, metadata
+from sotodlib.core import AxisManager, Context, LabelAxis, metadata
 from sotodlib.io.metadata import read_dataset, write_dataset
 from sotodlib.site_pipeline import util
 
@@ -107,9 +109,9 @@ class FocalPlane:
     transform_nocm: Transform = field(init=False, default_factory=Transform.identity)
 
     def __post_init__(self, n_aman):
-        self.full_fp = np.nan + np.empty(self.template.fp.shape + (n_aman,))
+        self.full_fp = np.full(self.template.fp.shape + (n_aman,), np.nan)
         self.tot_weight = np.zeros(len(self.template.det_ids))
-        self.avg_fp = np.nan + np.empty_like(self.template.fp)
+        self.avg_fp = np.full_like(self.template.fp, np.nan)
         self.weight = np.zeros(len(self.template.det_ids))
         self.transformed = self.template.fp.copy()
         self.center_transformed = self.template.center.copy()
@@ -122,15 +124,15 @@ class FocalPlane:
         )
         if len(msk) != aman.dets.count:
             logger.warning("There are matched dets not found in the template")
-        mapping = np.argsort(np.argsort(self.template.det_ids[template_msk]))
-        srt = np.argsort(aman.det_info.det_id[msk])
-        xi = aman.pointing.xi[msk][srt][mapping]
-        eta = aman.pointing.eta[msk][srt][mapping]
+        # intersect1d returns indices into both inputs in order of the
+        # sorted common det_ids, so msk and template_msk are already aligned
+        xi = aman.pointing.xi[msk]
+        eta = aman.pointing.eta[msk]
         if "polarization" in aman:
             # name of field just a placeholder for now
-            gamma = aman.polarization.polang[msk][srt][mapping]
+            gamma = aman.polarization.polang[msk]
         elif "gamma" in aman.pointing:
-            gamma = aman.pointing.gamma[msk][srt][mapping]
+            gamma = aman.pointing.gamma[msk]
         else:
             gamma = np.nan + np.empty(len(xi))
         fp = np.vstack((xi, eta, gamma))
@@ -283,7 +285,7 @@ def _avg_focalplane(full_fp, tot_weight):
     avg_weight = tot_weight / n_obs
 
     # nansum all all nans is 0, addressing that case here
-    all_nan = ~np.any(np.isfinite(full_fp).reshape((len(full_fp), -1)), axis=1)
+    all_nan = ~np.any(msk.reshape((len(full_fp), -1)), axis=1)
     avg_fp[all_nan] = np.nan
 
     return avg_fp, avg_weight, n_point, n_gamma
@@ -426,55 +428,82 @@ def _load_template(template_path, ufm, pointing_cfg):
     )
 
 
+def _load_ctx_obs(ctx, obs_id, dets, names):
+    tod_pointing_name, map_pointing_name, pol_name, dm_name = names
+    amans = []
+    aman = ctx.get_meta(obs_id, dets=dets)
+    if "det_info" not in aman:
+        raise ValueError(f"No det_info in {obs_id}")
+    if "wafer" not in aman.det_info and dm_name in aman:
+        dm_aman = aman[dm_name].copy()
+        aman.det_info.wrap("wafer", dm_aman)
+        if "det_id" not in aman.det_info:
+            aman.det_info.wrap(
+                "det_id", aman.det_info.wafer.det_id, [(0, aman.dets)]
+            )
+    if "det_id" in aman.det_info:
+        aman.restrict("dets", ~np.isin(aman.det_info.det_id, ["", "NO_MATCH"]))
+    else:
+        raise ValueError(f"No detmap for {obs_id}")
+    pol = pol_name in aman
+    if pol:
+        aman.move(pol_name, "polarization")
+    else:
+        logger.warning("No polarization data in context")
+
+    if tod_pointing_name in aman:
+        _aman = aman.copy()
+        _aman.move(tod_pointing_name, "pointing")
+        amans.append(_aman)
+    if map_pointing_name in aman:
+        _aman = aman.copy()
+        _aman.move(map_pointing_name, "pointing")
+        amans.append(_aman)
+    elif tod_pointing_name not in aman:
+        raise ValueError(f"No pointing found in {obs_id}")
+    return amans
+
+
 def _load_ctx(config):
     ctx = Context(config["context"]["path"])
     tod_pointing_name = config["context"].get("tod_pointing", "tod_pointing")
     map_pointing_name = config["context"].get("map_pointing", "map_pointing")
     pol_name = config["context"].get("polarization", "polarization")
     dm_name = config["context"].get("detmap", "detmap")
-    query = []
+    names = (tod_pointing_name, map_pointing_name, pol_name, dm_name)
+    obs_ids = [np.atleast_1d(np.asarray(config["context"].get("obs_ids", []), dtype=str))]
     if "query" in config["context"]:
-        query = (ctx.obsdb.query(config["context"]["query"])["obs_id"],)
-    obs_ids = np.append(config["context"].get("obs_ids", []), query)
-    obs_ids = np.unique(obs_ids)
+        obs_ids.append(
+            np.asarray(ctx.obsdb.query(config["context"]["query"])["obs_id"], dtype=str)
+        )
+    obs_ids = np.unique(np.concatenate(obs_ids))
     if len(obs_ids) == 0:
         raise ValueError("No observations provided in configuration")
     _config = config.copy()
     if "query" in _config["context"]:
         del _config["context"]["query"]
-    amans = []
     dets = config["context"].get("dets", {})
-    for obs_id in obs_ids:
-        aman = ctx.get_meta(obs_id, dets=dets)
-        if "det_info" not in aman:
-            raise ValueError(f"No det_info in {obs_id}")
-        if "wafer" not in aman.det_info and dm_name in aman:
-            dm_aman = aman[dm_name].copy()
-            aman.det_info.wrap("wafer", dm_aman)
-            if "det_id" not in aman.det_info:
-                aman.det_info.wrap(
-                    "det_id", aman.det_info.wafer.det_id, [(0, aman.dets)]
-                )
-        if "det_id" in aman.det_info:
-            aman.restrict("dets", ~np.isin(aman.det_info.det_id, ["", "NO_MATCH"]))
-        else:
-            raise ValueError(f"No detmap for {obs_id}")
-        pol = pol_name in aman
-        if pol:
-            aman.move(pol_name, "polarization")
-        else:
-            logger.warning("No polarization data in context")
-
-        if tod_pointing_name in aman:
-            _aman = aman.copy()
-            _aman.move(tod_pointing_name, "pointing")
-            amans.append(_aman)
-        if map_pointing_name in aman:
-            _aman = aman.copy()
-            _aman.move(map_pointing_name, "pointing")
-            amans.append(_aman)
-        elif tod_pointing_name not in aman:
-            raise ValueError(f"No pointing found in {obs_id}")
+
+    n_threads = config["context"].get("n_threads", 1)
+    if not isinstance(n_threads, int) or n_threads < 1:
+        raise ValueError(f"context.n_threads must be a positive int, got {n_threads}")
+    amans = []
+    if n_threads == 1:
+        for obs_id in obs_ids:
+            amans += _load_ctx_obs(ctx, obs_id, dets, names)
+    else:
+        # Loading is I/O bound so fetch observations in parallel.
+        # Each thread gets its own Context since the databases are sqlite.
+        local = threading.local()
+
+        def _load(obs_id):
+            if not hasattr(local, "ctx"):
+                local.ctx = Context(config["context"]["path"])
+            return _load_ctx_obs(local.ctx, obs_id, dets, names)
+
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            for obs_amans in executor.map(_load, obs_ids):
+                amans += obs_amans
     stream_ids = np.unique(np.concatenate([aman.det_info.stream_id for aman in amans]))
 
     return amans, obs_ids, stream_ids
@@ -581,6 +610,16 @@ def _mk_pointing_config(telescope_flavor, tube_slot, wafer_slot, config):
     return pointing_cfg
 
 
+def _group_by_stream(aman):
+    # Map each stream_id to the indices of its dets with a single sort
+    if aman is None:
+        return {}
+    uniq, inv = np.unique(aman.det_info.stream_id, return_inverse=True)
+    order = np.argsort(inv, kind="stable")
+    splits = np.searchsorted(inv[order], np.arange(1, len(uniq)))
+    return dict(zip(uniq, np.split(order, splits)))
+
+
 def _restrict_inliers(aman, focal_plane):
     # TODO: Use gamma as well
     # Map to template
@@ -671,16 +710,20 @@ def main():
         logger.error("Provided template doesn't exist, trying to generate one")
         gen_template = True
     ots = {}
+    stream_groups = [_group_by_stream(aman) for aman in amans]
     for stream_id in stream_ids:
         logger.info("Working on %s", stream_id)
 
         # Limit ourselves to amans with this stream_id and restrict
+        # restrict_axes slices the child AxisManagers directly, whereas
+        # restrict(in_place=False) would deep copy each of them first
         amans_restrict = [
-            aman.copy().restrict(
-                "dets", aman.dets.vals[aman.det_info.stream_id == stream_id]
+            aman.restrict_axes(
+                [LabelAxis("dets", aman.dets.vals[groups[stream_id]])],
+                in_place=False,
             )
-            for aman in amans
-            if aman is not None and stream_id in aman.det_info.stream_id
+            for aman, groups in zip(amans, stream_groups)
+            if stream_id in groups
         ]
         if len(amans_restrict) == 0:
             logger.error(
@@ -723,7 +766,7 @@ def main():
                 "No template provided and unable to generate one for some reason"
             )
 
-        focal_plane = FocalPlane(template, stream_id, len(amans))
+        focal_plane = FocalPlane(template, stream_id, len(amans_restrict))
         for i, (aman, obs_id) in enumerate(zip(amans_restrict, obs_ids)):
             logger.info("\tWorking on %s", obs_id)
             if aman.dets.count == 0:
@@ -86,7 +86,8 @@ def preprocess_obs(
             scheme=scheme
         )
 
-    pipe = Pipeline(configs["process_pipe"], plot_dir=configs["plot_dir"], logger=logger)
+    pipe = Pipeline(configs["process_pipe"], plot_dir=configs["plot_dir"], logger=logger,
+                    n_threads=configs.get("n_threads", 1))
 
     logger.info(f"Beginning run for {obs_id}")
 
@@ -128,7 +129,8 @@ def load_preprocess_obs(obs_id, configs="preprocess_obs_configs.yaml", context=N
     configs, context = _get_preprocess_context(configs, context)
     meta = load_preprocess_det_select(obs_id, configs=configs, context=context)
     
-    pipe = Pipeline(configs["process_pipe"], logger=logger)
+    pipe = Pipeline(configs["process_pipe"], logger=logger,
+                    n_threads=configs.get("n_threads", 1))
     aman = context.get_obs(meta, no_signal=True)
     pipe.run(aman, aman.preprocess)
     return aman
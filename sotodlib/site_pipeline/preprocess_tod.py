@@ -22,7 +22,8 @@ def dummy_preproc(obs_id, group_list, logger,
     outputs = []
     context = core.Context(configs["context_file"])
     group_by, groups = _get_groups(obs_id, configs, context)
-    pipe = Pipeline(configs["process_pipe"], plot_dir=configs["plot_dir"], logger=logger)
+    pipe = Pipeline(configs["process_pipe"], plot_dir=configs["plot_dir"], logger=logger,
+                    n_threads=configs.get("n_threads", 1))
     for group in groups:
         logger.info(f"Beginning run for {obs_id}:{group}")
         proc_aman = core.AxisManager(core.LabelAxis('dets', ['det%i' % i for i in range(3)]),
@@ -175,7 +176,8 @@ def preprocess_tod(obs_id,
     if not(run_parallel):
         db = _get_preprocess_db(configs, group_by)
     
-    pipe = Pipeline(configs["process_pipe"], plot_dir=configs["plot_dir"], logger=logger)
+    pipe = Pipeline(configs["process_pipe"], plot_dir=configs["plot_dir"], logger=logger,
+                    n_threads=configs.get("n_threads", 1))
 
     for group in groups:
         logger.info(f"Beginning run for {obs_id}:{group}")
@@ -239,7 +241,8 @@ def load_preprocess_det_select(obs_id, configs, context=None,
         Can be pre-restricted in any way. See context.get_meta.
     """
     configs, context = _get_preprocess_context(configs, context)
-    pipe = Pipeline(configs["process_pipe"], logger=logger)
+    pipe = Pipeline(configs["process_pipe"], logger=logger,
+                    n_threads=configs.get("n_threads", 1))
     
     meta = context.get_meta(obs_id, dets=dets, meta=meta)
     logger.info(f"Cutting on the last process: {pipe[-1].name}")
@@ -274,7 +277,8 @@ def load_preprocess_tod(obs_id, configs="preprocess_configs.yaml",
         logger.info(f"No detectors left after cuts in obs {obs_id}")
         return None
     else:
-        pipe = Pipeline(configs["process_pipe"], logger=logger)
+        pipe = Pipeline(configs["process_pipe"], logger=logger,
+                        n_threads=configs.get("n_threads", 1))
         aman = context.get_obs(meta)
         pipe.run(aman, aman.preprocess)
         return aman
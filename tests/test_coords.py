@@ -184,5 +184,57 @@ class CoordsUtilsTest(unittest.TestCase):
                                    atol=R*0.05)
         self.assertEqual(len(xi), 16)
 
+
+class AffineTest(unittest.TestCase):
+    def setUp(self):
+        self.affine = np.array([[1.1, 0.2], [-0.15, 0.9]])
+        self.shift = np.array([0.3, -0.7])
+
+    def _symmetric_points(self, npair, dtype=np.float64):
+        # Points in +/- pairs so the median center is exact
+        pts = np.random.default_rng(0).normal(size=(2, npair))
+        src = np.hstack([pts, -pts])
+        dst = self.affine @ src + self.shift[:, None]
+        # Drop a few pairs to check the finite masking
+        src[0, [3, 3 + npair]] = np.nan
+        dst[1, [8, 8 + npair]] = np.nan
+        return src.astype(dtype), dst.astype(dtype)
+
+    def test_get_affine(self):
+        from sotodlib.coords import affine as af
+        src, dst = self._symmetric_points(100)
+        affine, shift = af.get_affine(src, dst)
+        np.testing.assert_allclose(affine, self.affine, atol=1e-10)
+        np.testing.assert_allclose(shift, self.shift, atol=1e-10)
+
+    def test_get_affine_centered(self):
+        from sotodlib.coords import affine as af
+        src, _ = self._symmetric_points(100)
+        dst = self.affine @ src
+        affine, shift = af.get_affine(src, dst, centered=True)
+        np.testing.assert_allclose(affine, self.affine, atol=1e-10)
+        np.testing.assert_allclose(shift, 0, atol=1e-10)
+
+    def test_get_affine_float32(self):
+        from sotodlib.coords import affine as af
+        src, dst = self._symmetric_points(100, np.float32)
+        affine, shift = af.get_affine(src, dst)
+        np.testing.assert_allclose(affine, self.affine, atol=1e-5)
+        np.testing.assert_allclose(shift, self.shift, atol=1e-5)
+
+    def test_get_affine_few_points(self):
+        from sotodlib.coords import affine as af
+        # 3 finite points, fewer than 2*ndim
+        src = np.random.default_rng(1).normal(size=(2, 3))
+        dst = self.affine @ src
+        src = np.hstack([src, np.full((2, 2), np.nan)])
+        dst = np.hstack([dst, np.ones((2, 2))])
+        affine, shift = af.get_affine(src, dst, centered=True)
+        np.testing.assert_allclose(affine, self.affine, atol=1e-10)
+        np.testing.assert_allclose(shift, 0, atol=1e-10)
+        with self.assertRaises(ValueError):
+            af.get_affine(src[:, :1], dst[:, :1])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -6,12 +6,14 @@
 """
 
 import unittest
+from unittest import mock
 import numpy as np
 import pylab as pl
 import scipy.signal
 
 from sotodlib import core, tod_ops
-from sotodlib.preprocess.pcore import _expand
+from sotodlib.preprocess import pcore
+from sotodlib.preprocess.pcore import _expand, update_full_aman, _reform_csr_array
 
 from numpy.testing import assert_array_equal
 
@@ -22,6 +24,26 @@ from .test_tod_ops import get_tod
 from so3g.proj import Ranges, RangesMatrix
 from scipy.sparse import csr_array
 
+def _make_proc_aman(ndets=6, nsamps=500, nfields=4):
+    """Full and proc AxisManagers with several sub-managers, with dets and
+    samps cut from proc_aman"""
+    aman = get_tod(sig_type='trendy', ndets=ndets, nsamps=nsamps)
+    full = core.AxisManager( aman.dets, aman.samps)
+    proc_aman = core.AxisManager( aman.dets, aman.samps)
+    for i in range(nfields):
+        sub = core.AxisManager( aman.dets, aman.samps)
+        sub.wrap('arr', aman.signal*(i+1), [(0,'dets'), (1,'samps')])
+        flag = RangesMatrix.zeros( (aman.dets.count, aman.samps.count))
+        flag[i].add_interval( 10*i, 100+10*i)
+        sub.wrap('flag', flag, [(0,'dets'), (1,'samps')])
+        child = core.AxisManager( aman.dets)
+        child.wrap('per_det', np.arange(aman.dets.count)+i, [(0,'dets')])
+        sub.wrap('child', child)
+        proc_aman.wrap(f'fld{i}', sub)
+    proc_aman.restrict('dets', aman.dets.vals[[0, 2, 3, 5]])
+    proc_aman.restrict('samps', (50, None))
+    return full, proc_aman
+
 class TestExpand(unittest.TestCase):
 
     def test_100_expand(self):
@@ -58,10 +80,22 @@ class TestExpand(unittest.TestCase):
         proc_aman.wrap('csr_thing', csr_array(proc_aman['sparse_thing']),
             [(0,'dets'), (1,'samps')])
 
+        # wrap a nested AxisManager
+        child = core.AxisManager( aman.dets, aman.samps)
+        child.wrap('arr4', np.arange(aman.dets.count), [(0,'dets')])
+        proc_aman.wrap('child', child)
+
         ## test same size expansion
         out = _expand( proc_aman, full)
         assert_array_equal( out.flag1[0].ranges()[0] , [100,700] )
         assert_array_equal( out.sparse_thing, out.csr_thing.toarray() )
+        # matching axes are referenced, not re-allocated
+        self.assertTrue( np.shares_memory(out.arr3, proc_aman.arr3) )
+        self.assertTrue( np.all(out.valid.mask()) )
+        # the nested child gets its own valid, without touching proc_aman
+        self.assertTrue( np.all(out.child.valid.mask()) )
+        self.assertTrue( 'valid' not in proc_aman.child )
+        self.assertTrue( 'valid' not in proc_aman )
 
         ## test with detectors cut
         aman.restrict( 'dets', aman.dets.vals[3:5])
@@ -76,6 +110,8 @@ class TestExpand(unittest.TestCase):
         out = _expand( proc_aman, full)
         assert_array_equal( proc_aman.flag1[0].ranges()[0] , [0,500] )
         assert_array_equal( out.flag1[3].ranges()[0] , [300,800] )
+        assert_array_equal( proc_aman.flag2.ranges() , [[150,400]] )
+        assert_array_equal( out.flag2.ranges() , [[450,700]] )
         assert_array_equal( out.sparse_thing, out.csr_thing.toarray() )
 
         ## test with a wrapped axis manager
@@ -104,6 +140,73 @@ class TestExpand(unittest.TestCase):
         out = _expand( proc_aman, full)
         assert_array_equal( out.sparse_thing, out.csr_thing.toarray() )
 
+    def test_200_update_full_aman_threads(self):
+        full1, proc_aman = _make_proc_aman()
+        full4 = core.AxisManager( full1.dets, full1.samps)
+        update_full_aman( proc_aman, full1, True, n_threads=1)
+        update_full_aman( proc_aman, full4, True, n_threads=4)
+
+        self.assertEqual( list(full1._fields), list(full4._fields) )
+        for fld in full1._fields:
+            a, b = full1[fld], full4[fld]
+            assert_array_equal( a.arr, b.arr )
+            assert_array_equal( a.flag.mask(), b.flag.mask() )
+            assert_array_equal( a.valid.mask(), b.valid.mask() )
+            assert_array_equal( a.child.per_det, b.child.per_det )
+            assert_array_equal( a.child.valid.mask(), b.child.valid.mask() )
+        # cut dets are zero and invalid
+        assert_array_equal( full4.fld1.arr[1], 0 )
+        self.assertFalse( np.any(full4.fld1.valid[1].mask()) )
+        assert_array_equal( full4.fld1.valid[0].ranges(), [[50, 500]] )
+
+
+    def test_300_expand_permuted_csr(self):
+        aman = get_tod(sig_type='trendy', ndets=6, nsamps=200)
+        full = core.AxisManager( aman.dets, aman.samps)
+        dense = 1. * (np.random.uniform(size=(6, 200)) > .9)
+        proc_aman = core.AxisManager( aman.dets, aman.samps)
+        proc_aman.wrap('dense', dense, [(0,'dets'), (1,'samps')])
+        proc_aman.wrap('csr', csr_array(dense), [(0,'dets'), (1,'samps')])
+
+        # dets subset in a different order than full, so rows are reordered
+        proc_aman.restrict('dets', aman.dets.vals[[4, 1, 3]])
+        proc_aman.restrict('samps', (20, None))
+        out = _expand( proc_aman, full)
+        assert_array_equal( out.dense, out.csr.toarray() )
+        assert_array_equal( out.csr.toarray()[[1, 3, 4], 20:], dense[[1, 3, 4], 20:] )
+
+        # rows of arr that are not mapped into the frame are an error
+        arr = csr_array(dense[:3])
+        with self.assertRaises(ValueError):
+            _reform_csr_array( arr, (np.array([0, 1]), slice(0, 200)),
+                               (np.array([0, 1]), slice(0, 200)), (6, 200))
+
+
+    def test_400_intersection_cache(self):
+        full, proc_aman = _make_proc_aman(nfields=2)
+        # the sub-managers hold distinct but equal dets axes
+        self.assertIsNot( proc_aman.fld0.dets, proc_aman.fld1.dets )
+
+        calls = []
+        orig = pcore._intersect_axes
+        def spy(f_ax, n_ax, cache=None):
+            n_before = len(cache.get(n_ax.name, []))
+            out = orig(f_ax, n_ax, cache)
+            calls.append((f_ax, n_ax, id(cache), n_before, out))
+            return out
+        with mock.patch.object(pcore, '_intersect_axes', spy):
+            update_full_aman( proc_aman, full, True)
+
+        det_calls = [c for c in calls if c[1].name == 'dets']
+        # fld0, fld0.child, fld1, fld1.child
+        self.assertEqual( len(det_calls), 4 )
+        self.assertEqual( len(set(c[2] for c in calls)), 1 )
+        # only the first lookup computes the intersection
+        self.assertEqual( [c[3] for c in det_calls], [0, 1, 1, 1] )
+        for f_ax, n_ax, _, _, (fs, ns) in det_calls:
+            _, fs0, ns0 = f_ax.intersection(n_ax, return_slices=True)
+            assert_array_equal( fs, fs0 )
+            assert_array_equal( ns, ns0 )
 
 
 if __name__ == '__main__':